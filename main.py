@@ -1,20 +1,99 @@
 # main.py
 import os
 import time
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import random
+import re
+import tempfile
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
 from pydantic import BaseModel, HttpUrl
 from dotenv import load_dotenv
 from typing import List, Dict, Any
-import requests
-from github import Github
-import base64
+import httpx
+from github import Github, GithubException, GithubRetry
 
 # --- Load Environment Variables ---
 load_dotenv()
 MY_SECRET = os.getenv("STUDENT_SECRET")
 GITHUB_USERNAME = os.getenv("GITHUB_USERNAME") # Add your GitHub username to .env
-
-app = FastAPI()
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_MODEL = "gpt-4o"
+# Bump whenever the prompt template changes, so cached pages built from the old prompt aren't reused
+LLM_PROMPT_VERSION = 2
+
+# --- Retry policy for GitHub calls: back off on rate limits and transient server errors ---
+GITHUB_MAX_RETRIES = 5
+GITHUB_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+GITHUB_MAX_RETRY_DELAY = 60  # Never sleep longer than this between retries, whatever the headers say
+# GithubRetry (a urllib3 Retry subclass) also recognizes GitHub's 403 primary/secondary rate-limit responses.
+# Its defaults leave out PATCH/PUT/DELETE, so list the methods explicitly.
+GITHUB_RETRY = GithubRetry(
+    total=GITHUB_MAX_RETRIES, backoff_factor=1, status_forcelist=GITHUB_RETRY_STATUSES,
+    allowed_methods=frozenset(["GET", "POST", "PUT", "PATCH", "DELETE"]),
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- Shared async HTTP client so in-flight tasks reuse pooled (HTTP/2) connections ---
+    app.state.http = httpx.AsyncClient(
+        http2=True, timeout=30, limits=httpx.Limits(max_keepalive_connections=20)
+    )
+    # --- Single worker that applies GitHub writes one at a time ---
+    app.state.gh_queue = asyncio.Queue()
+    gh_worker = asyncio.create_task(github_write_worker(app.state.gh_queue))
+    yield
+    gh_worker.cancel()
+    try:
+        await gh_worker
+    except asyncio.CancelledError:
+        pass
+    # Fail writes that never reached the worker, so tasks waiting on them don't hang at shutdown
+    while not app.state.gh_queue.empty():
+        *_, future = app.state.gh_queue.get_nowait()
+        if not future.done():
+            future.set_exception(RuntimeError("Server shutting down; GitHub write not performed."))
+    await app.state.http.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# GitHub's secondary rate limits punish concurrent mutative requests, so pause between them
+GITHUB_WRITE_PAUSE = 1.0
+
+async def github_write_worker(queue: asyncio.Queue):
+    """
+    Runs queued GitHub writes sequentially, pausing GITHUB_WRITE_PAUSE seconds after each one.
+    """
+    while True:
+        func, args, kwargs, future = await queue.get()
+        try:
+            result = await func(*args, **kwargs)
+            if not future.cancelled():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        finally:
+            queue.task_done()
+        await asyncio.sleep(GITHUB_WRITE_PAUSE)
+
+async def github_write(func, *args, **kwargs):
+    """
+    Enqueues a single mutative GitHub request (a coroutine function) and waits for its result.
+    Queued calls must not retry or sleep themselves, or they'd stall every other task's writes;
+    use github_request(write=True), which waits between attempts outside the queue.
+    Reads should be called directly; they aren't subject to the write pacing.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await app.state.gh_queue.put((func, args, kwargs, future))
+    return await future
 
 # --- Pydantic Models for Data Validation ---
 class TaskRequest(BaseModel):
@@ -28,11 +107,149 @@ class TaskRequest(BaseModel):
     evaluation_url: HttpUrl
     attachments: List[Dict[str, Any]]
 
-def generate_code_with_llm(brief: str, checks: list, attachments: list) -> str:
+def llm_cache_key(brief: str, checks: list, attachments: list) -> str:
+    """
+    Content-addressed key for an LLM request: identical briefs, checks and attachments map to the same key.
+    """
+    key_data = {
+        "m": LLM_MODEL,
+        "v": LLM_PROMPT_VERSION,
+        "b": brief,
+        "c": sorted(checks),
+        "a": [(a["name"], a["size"]) for a in attachments],
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+def mime_from_datauri(data_uri: str) -> str:
+    """
+    Extracts the MIME type from a data URI, e.g. "data:image/png;base64,..." -> "image/png".
+    """
+    header = data_uri[:data_uri.find(",")]  # Slice rather than split, to avoid copying the payload
+    return header.removeprefix("data:").split(";", 1)[0] or "application/octet-stream"
+
+# Attachment payloads are copied in chunks to temp files that stay in memory up to the spool size
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_SPOOL_SIZE = 1 << 20
+# Like b64decode's default mode, ignore anything outside the Base64 alphabet (e.g. MIME line breaks)
+BASE64_JUNK_RE = re.compile(r"[^A-Za-z0-9+/=]")
+
+def preprocess_attachments(attachments: list) -> list:
+    """
+    Parses each attachment data URI once into {"name", "mime", "size", "data"}, where "data" is a
+    SpooledTemporaryFile holding the normalised Base64 payload, and drops the URI from the request.
+    Blocking, so call it via asyncio.to_thread. Invalid attachments are skipped.
+    """
+    parsed = []
+    for attachment in attachments:
+        file_name = attachment.get("name")
+        data_uri = attachment.get("url")
+        if not file_name or not data_uri:
+            continue
+        spool = None
+        try:
+            comma = data_uri.find(",")
+            if comma == -1 or not data_uri[:comma].endswith(";base64"):
+                raise ValueError("not a Base64 data URI")
+
+            # Normalise while spooling: drop whitespace/non-alphabet characters, then re-pad
+            spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+            cleaned_length, tail = 0, ""
+            for start in range(comma + 1, len(data_uri), ATTACHMENT_CHUNK_SIZE):
+                chunk = BASE64_JUNK_RE.sub("", data_uri[start:start + ATTACHMENT_CHUNK_SIZE])
+                spool.write(chunk.encode("ascii"))
+                cleaned_length += len(chunk)
+                tail = (tail + chunk)[-2:]
+            data_length = cleaned_length - tail.count("=")
+            if data_length % 4 == 1:
+                raise ValueError("truncated Base64 payload")
+            spool.write(b"=" * (-cleaned_length % 4))
+            size = data_length * 3 // 4
+
+            parsed.append({"name": file_name, "mime": mime_from_datauri(data_uri), "size": size, "data": spool})
+            attachment["url"] = None
+        except Exception as e:
+            if spool is not None:
+                spool.close()
+            print(f"⚠️  Could not process attachment {file_name}: {e}")
+    return parsed
+
+def deployment_nonce_tag(nonce: str) -> str:
+    """
+    The meta tag that marks a deployment; polling looks for it on the live page.
+    """
+    return f'<meta name="deployment-nonce" content="{nonce}">'
+
+# Matches the closing head tag in any case and with stray whitespace, e.g. </HEAD> or </head >
+HEAD_CLOSE_RE = re.compile(r"</head\s*>", re.IGNORECASE)
+# Fallback anchors for HTML5 that omits the optional </head>: an opening <head ...> (not <header>), or <body
+HEAD_OPEN_RE = re.compile(r"<head(?:\s[^>]*)?>", re.IGNORECASE)
+BODY_OPEN_RE = re.compile(r"<body[\s>]", re.IGNORECASE)
+
+def inject_nonce(html_code: str, nonce: str) -> str:
+    """
+    Injects the deployment nonce meta tag before </head>, or right after <head> / before <body> when
+    </head> is omitted. Fragments with none of these are wrapped in a minimal document instead,
+    so we never deploy a page the poller can't confirm.
+    """
+    nonce_meta_tag = deployment_nonce_tag(nonce)
+    # Function replacements keep the nonce literal (no backslash/group expansion)
+    injected, count = HEAD_CLOSE_RE.subn(lambda match: f"    {nonce_meta_tag}\n{match.group(0)}", html_code, count=1)
+    if not count:
+        injected, count = HEAD_OPEN_RE.subn(lambda match: f"{match.group(0)}\n    {nonce_meta_tag}", html_code, count=1)
+    if not count:
+        injected, count = BODY_OPEN_RE.subn(lambda match: f"{nonce_meta_tag}\n{match.group(0)}", html_code, count=1)
+    if not count:
+        print("⚠️  Generated HTML has no <head> or <body>; wrapping it to inject the nonce.")
+        injected = f"<!DOCTYPE html><html><head>{nonce_meta_tag}</head><body>{html_code}</body></html>"
+    return injected
+
+def read_llm_cache(cache_path: str):
+    """
+    Returns the cached page at cache_path, or None on a miss or an unreadable entry.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"⚠️  Ignoring unreadable LLM cache entry: {e}")
+        return None
+
+def write_llm_cache(cache_path: str, code: str):
     """
-    Generates HTML by instructing the LLM to directly embed attachment data URIs.
-    This is the correct approach for creating a single, self-contained HTML file.
+    Stores a page in the LLM cache. Failures are logged, never raised.
     """
+    tmp_path = None
+    try:
+        # Write to a temp file and rename it into place, so concurrent readers never see a partial page
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=LLM_CACHE_DIR, suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            f.write(code)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️  Could not cache LLM response: {e}")
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+async def generate_code_with_llm(brief: str, checks: list, attachments: list) -> str:
+    """
+    Generates HTML, instructing the LLM to reference attachments by filename.
+    The attachments are committed next to index.html, so only their names and types go into the prompt.
+    """
+    # Identical requests (retries, dev testing) are served from disk at no API cost
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{llm_cache_key(brief, checks, attachments)}.html")
+    cached = await asyncio.to_thread(read_llm_cache, cache_path)
+    if cached is not None:
+        print("♻️  Using cached LLM response.")
+        return cached
+
     print("🤖 Calling aipipe.org API to generate code...")
     api_key = os.getenv("AIPIPE_TOKEN")
     if not api_key:
@@ -45,20 +262,19 @@ def generate_code_with_llm(brief: str, checks: list, attachments: list) -> str:
         "Content-Type": "application/json",
     }
 
-    # --- Create attachments context with instructions to embed the data URI ---
+    # --- Create attachments context listing the files served alongside the page ---
     attachments_context = ""
     if attachments:
-        attachments_context += "\n\nThe following file attachments are provided as data URIs. **Do not decode or process the Base64 content.** You must embed the entire data URI string directly into the appropriate HTML tags.\n"
-        attachments_context += "For example, for an image named 'sample.png', you would generate a tag like: <img src=\"data:image/png;base64,iVBORw...\">\n"
+        attachments_context += "\n\nThe following files will be deployed in the same directory as the HTML file. Reference attachments by filename using relative paths.\n"
+        attachments_context += "For example, for an image named 'sample.png', you would generate a tag like: <img src='sample.png'>\n"
         for attachment in attachments:
-            file_name = attachment.get("name", "unknown_file")
-            data_uri = attachment.get("url", "")
-            attachments_context += f"\n--- FILE: {file_name} ---\n{data_uri}\n--- END FILE ---\n"
+            attachments_context += f"\n- {attachment['name']} ({attachment['mime']}, {attachment['size']} bytes)"
+        attachments_context += "\n"
 
     # --- The final, optimized prompt ---
     prompt = f"""
     You are an expert front-end web developer. Your task is to generate a single, complete, self-contained HTML file.
-    All CSS, JavaScript, and other assets must be included directly within the HTML file.
+    All CSS and JavaScript must be included directly within the HTML file.
 
     The user's application brief is:
     ---
@@ -73,21 +289,31 @@ def generate_code_with_llm(brief: str, checks: list, attachments: list) -> str:
     Respond with only the raw HTML code and nothing else.
     """
     
-    payload = {"model": "gpt-4o", "input": prompt}
+    payload = {"model": LLM_MODEL, "input": prompt}
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        # Generation can take well over the client default, so don't time it out
+        response = await app.state.http.post(url, headers=headers, json=payload, timeout=None)
         response.raise_for_status()
         response_data = response.json()
         code = response_data["output"][0]["content"][0]["text"].strip()
         
-        # Cleanup logic remains the same
+        # Strip a surrounding Markdown code fence.
+        # A fence with no newline next to it means there's no code outside it; "" is caught as a failure
         if code.startswith("```"):
-            code = code.split('\n', 1)[1]
+            newline = code.find("\n")
+            code = code[newline + 1:] if newline != -1 else ""
         if code.endswith("```"):
-            code = '\n'.join(code.split('\n')[:-1])
+            newline = code.rfind("\n")
+            code = code[:newline] if newline != -1 else ""
             
+        # Callers treat empty output and error pages as failures; never cache those, or retries could never recover
+        if not code or code.startswith("<h1>Error"):
+            print("❌ LLM returned no usable code.")
+            return code
+
         print("✅ LLM code generation successful.")
+        await asyncio.to_thread(write_llm_cache, cache_path, code)
         return code
         
     except Exception as e:
@@ -115,9 +341,79 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-def enable_github_pages(repo_full_name: str, token: str):
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    """
+    How long to wait before retrying a GitHub request: honors Retry-After and
+    x-ratelimit-reset, otherwise falls back to exponential backoff (1, 2, 4, 8... seconds).
+    Capped at GITHUB_MAX_RETRY_DELAY.
+    """
+    retry_after = response.headers.get("retry-after")
+    if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+    elif response.headers.get("x-ratelimit-remaining") == "0":
+        reset_at = int(response.headers.get("x-ratelimit-reset", "0"))
+        delay = max(reset_at - time.time(), 1)
+    else:
+        delay = 2 ** attempt
+    return min(delay, GITHUB_MAX_RETRY_DELAY)
+
+async def github_request(method: str, url: str, write: bool = False, body_factory=None, **kwargs) -> httpx.Response:
+    """
+    Sends a request to the GitHub API on the shared client, retrying rate-limited and
+    transient failures (see GITHUB_RETRY_STATUSES). Returns the last response.
+    With write=True each attempt goes through the GitHub write queue; the retry waits happen
+    outside it, so a backing-off request doesn't hold up other tasks' writes.
+    body_factory, if given, returns a fresh streamed request body for each attempt.
+    """
+    for attempt in range(GITHUB_MAX_RETRIES + 1):
+        if body_factory is not None:
+            kwargs["content"] = body_factory()
+        try:
+            if write:
+                response = await github_write(app.state.http.request, method, url, **kwargs)
+            else:
+                response = await app.state.http.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == GITHUB_MAX_RETRIES:
+                raise
+            delay = 2 ** attempt
+            print(f"⚠️  GitHub request failed ({e}). Retrying in {delay}s...")
+        else:
+            # Secondary rate limits come back as 403/429 with Retry-After; primary ones as 403 with no quota left
+            is_rate_limited = response.status_code in (403, 429) and (
+                "retry-after" in response.headers or response.headers.get("x-ratelimit-remaining") == "0"
+            )
+            if attempt == GITHUB_MAX_RETRIES or not (response.status_code in GITHUB_RETRY_STATUSES or is_rate_limited):
+                return response
+            delay = retry_delay(response, attempt)
+            print(f"⚠️  GitHub returned {response.status_code}. Retrying in {delay:.0f}s...")
+        await asyncio.sleep(delay)
+
+GITHUB_API_URL = "https://api.github.com"
+
+def github_headers() -> dict:
+    """
+    Auth headers for direct GitHub REST calls.
+    """
+    return {
+        "Authorization": f"Bearer {os.getenv('GITHUB_PAT')}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+
+async def github_api(method: str, path: str, write: bool = False, headers: dict = None, **kwargs) -> dict:
+    """
+    Calls a GitHub REST endpoint through github_request and returns the decoded JSON.
+    Raises httpx.HTTPStatusError if the final attempt fails.
+    """
+    headers = {**github_headers(), **(headers or {})}
+    response = await github_request(method, f"{GITHUB_API_URL}{path}", write=write, headers=headers, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+async def enable_github_pages(repo_full_name: str, token: str):
     """
     Enables GitHub Pages for a repository using the GitHub REST API.
+    Safe to call again on retry: an already-enabled site counts as success.
     """
     print("🌍 Enabling GitHub Pages...")
     url = f"https://api.github.com/repos/{repo_full_name}/pages"
@@ -136,7 +432,16 @@ def enable_github_pages(repo_full_name: str, token: str):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        # Idempotent: if a previous attempt already enabled Pages, there's nothing to do
+        existing = await github_request("GET", url, headers=headers)
+        if existing.status_code == 200 and existing.json().get("status"):
+            print("✅ GitHub Pages already enabled.")
+            return True
+
+        response = await github_request("POST", url, write=True, headers=headers, json=payload)
+        if response.status_code == 409: # 409 Conflict means Pages is already enabled
+            print("✅ GitHub Pages already enabled.")
+            return True
         response.raise_for_status()  # Raises an exception for HTTP error codes
         
         if response.status_code == 201: # 201 Created is the success code
@@ -146,134 +451,292 @@ def enable_github_pages(repo_full_name: str, token: str):
             print(f"⚠️  Unexpected status code while enabling Pages: {response.status_code}")
             return False
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Failed to enable GitHub Pages: {e}")
-        print(f"Response: {e.response.text if e.response else 'No response'}")
+        error_response = getattr(e, "response", None)
+        print(f"Response: {error_response.text if error_response is not None else 'No response'}")
         return False
 
-def create_and_push_to_github(repo_name: str, html_content: str, brief: str, attachments: list) -> (str, str):
+@functools.lru_cache(maxsize=1)
+def get_github_client() -> Github:
+    """
+    Process-wide PyGithub client, so every task reuses the same authenticated, pooled connection.
+    """
+    return Github(os.getenv("GITHUB_PAT"), retry=GITHUB_RETRY, per_page=100, pool_size=20)
+
+@functools.lru_cache(maxsize=1)
+def get_github_user():
+    """
+    The authenticated user, loaded once per process instead of once per task.
+    """
+    user = get_github_client().get_user()
+    user.login  # Force the lazy profile fetch now, so later accesses are free
+    return user
+
+async def create_github_repo(repo_name: str, brief: str):
     """
-    Creates a GitHub repo, pushes files (including attachments), enables Pages, and returns the repo URL and commit SHA.
+    Creates a GitHub repo and seeds it with the README, which doesn't depend on the generated code.
+    Idempotent, so a retried round 1 can reuse a repo left behind by an earlier attempt.
+    Returns the repo object, or None on failure.
     """
-    repo = None
     try:
         print(f"🐙 Accessing GitHub...")
-        github_pat = os.getenv("GITHUB_PAT")
-        # ... (rest of the authentication logic) ...
-        g = Github(github_pat)
-        user = g.get_user()
+        user = await asyncio.to_thread(get_github_user)
         print(f"✓ Authenticated as: {user.login}")
 
         print(f"Creating new repository: {repo_name}...")
-        repo = user.create_repo(repo_name, private=False)
-        print(f"✓ Repository created: {repo.html_url}")
+        response = await github_request(
+            "POST", f"{GITHUB_API_URL}/user/repos", write=True,
+            headers=github_headers(), json={"name": repo_name, "private": False},
+        )
+        # 422 "name already exists": an earlier attempt (or a retried POST) already created it
+        already_exists = response.status_code == 422 and "already exists" in response.text
+        if not already_exists:
+            response.raise_for_status()
+        repo = await asyncio.to_thread(user.get_repo, repo_name)
+        print(f"✓ {'Reusing existing' if already_exists else 'Created'} repository: {repo.html_url}")
+
+        try:
+            await asyncio.to_thread(repo.get_branch, "main")
+            return repo  # Already bootstrapped
+        except GithubException as e:
+            if e.status != 404:
+                raise
 
         readme_content = f"# {repo_name}\n\nThis project was auto-generated based on the brief: '{brief}'"
 
-        # Create the primary files
-        repo.create_file("index.html", "feat: initial commit", html_content, branch="main")
-        repo.create_file("LICENSE", "feat: add MIT license", MIT_LICENSE, branch="main")
-        commit_info = repo.create_file("README.md", "feat: add readme", readme_content, branch="main")
+        # The Git Data API rejects empty repos, so the README commit also bootstraps the main branch
+        await github_api(
+            "PUT", f"/repos/{repo.full_name}/contents/README.md", write=True,
+            json={"message": "feat: add readme", "content": base64.b64encode(readme_content.encode()).decode(), "branch": "main"},
+        )
+        return repo
+
+    except Exception as e:
+        print(f"❌ GitHub repository creation failed: {e}")
+        return None
+
+# Base64 needs no JSON escaping, so a blob body can be streamed as prefix + raw payload + suffix
+BLOB_BODY_PREFIX = b'{"encoding": "base64", "content": "'
+BLOB_BODY_SUFFIX = b'"}'
+
+async def spooled_blob_body(spool):
+    """
+    Yields a blob-creation JSON body, reading the Base64 payload from the spool in chunks.
+    """
+    yield BLOB_BODY_PREFIX
+    await asyncio.to_thread(spool.seek, 0)
+    while chunk := await asyncio.to_thread(spool.read, ATTACHMENT_CHUNK_SIZE):
+        yield chunk
+    yield BLOB_BODY_SUFFIX
+
+async def create_spooled_blob(git_path: str, spool) -> dict:
+    """
+    Creates a blob from a spooled Base64 payload without loading it into memory.
+    """
+    payload_length = await asyncio.to_thread(spool.seek, 0, os.SEEK_END)
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": str(len(BLOB_BODY_PREFIX) + payload_length + len(BLOB_BODY_SUFFIX)),
+    }
+    return await github_api(
+        "POST", f"{git_path}/blobs", write=True, headers=headers, body_factory=lambda: spooled_blob_body(spool)
+    )
+
+async def commit_files_to_repo(repo_full_name: str, files: list, message: str, branch: str = "main") -> str:
+    """
+    Writes several files to a branch as a single commit using the Git Data API (blobs -> tree -> commit -> ref).
+    `files` is a list of (path, content, encoding) tuples, where encoding is "utf-8" or "base64"
+    and content is a string or a spooled file holding the Base64 payload (streamed, never loaded whole).
+    Returns the new commit SHA.
+    """
+    git_path = f"/repos/{repo_full_name}/git"
+    # Reads go straight to GitHub; each write goes through the paced write queue
+    ref = await github_api("GET", f"{git_path}/ref/heads/{branch}")
+    parent_sha = ref["object"]["sha"]
+    parent = await github_api("GET", f"{git_path}/commits/{parent_sha}")
+
+    tree_elements = []
+    for path, content, encoding in files:
+        if hasattr(content, "read"):
+            blob = await create_spooled_blob(git_path, content)
+        else:
+            blob = await github_api("POST", f"{git_path}/blobs", write=True, json={"content": content, "encoding": encoding})
+        tree_elements.append({"path": path, "mode": "100644", "type": "blob", "sha": blob["sha"]})
+
+    tree = await github_api(
+        "POST", f"{git_path}/trees", write=True, json={"base_tree": parent["tree"]["sha"], "tree": tree_elements}
+    )
+    commit = await github_api(
+        "POST", f"{git_path}/commits", write=True, json={"message": message, "tree": tree["sha"], "parents": [parent_sha]}
+    )
+    await github_api("PATCH", f"{git_path}/refs/heads/{branch}", write=True, json={"sha": commit["sha"]})
+    return commit["sha"]
+
+def attachment_files(attachments: list) -> list:
+    """
+    Converts preprocessed attachments into (path, content, encoding) entries for commit_files_to_repo.
+    """
+    files = []
+    for attachment in attachments:
+        print(f"   Adding attachment file: {attachment['name']}...")
+        # The spooled payload is already base64, so it can go straight into a blob
+        files.append((attachment["name"], attachment["data"], "base64"))
+    return files
+
+async def create_and_push_to_github(repo, html_content: str, attachments: list) -> (str, str):
+    """
+    Pushes the generated page, LICENSE and attachments to a freshly created repo in one commit, enables Pages, and returns the repo URL and commit SHA.
+    """
+    try:
+        github_pat = os.getenv("GITHUB_PAT")
+        files = [
+            ("index.html", html_content, "utf-8"),
+            ("LICENSE", MIT_LICENSE, "utf-8"),
+        ]
 
         # --- NEW: Process and create files from attachments ---
         if attachments:
             print("📎 Processing attachments...")
-            for attachment in attachments:
-                file_name = attachment.get("name")
-                data_uri = attachment.get("url")
-                if not file_name or not data_uri:
-                    continue
-                try:
-                    header, encoded_data = data_uri.split(",", 1)
-                    decoded_content = base64.b64decode(encoded_data)
-                    print(f"   Creating attachment file: {file_name}...")
-                    repo.create_file(file_name, f"feat: add attachment {file_name}", decoded_content, branch="main")
-                except Exception as e:
-                    print(f"⚠️  Could not process attachment {file_name}: {e}")
+            files += attachment_files(attachments)
         
-        commit = commit_info["commit"]
+        commit_sha = await commit_files_to_repo(repo.full_name, files, "feat: initial commit")
         print(f"✅ Successfully created repo and pushed all files.")
         
-        enable_github_pages(repo.full_name, github_pat)
-        return repo.html_url, commit.sha
+        await enable_github_pages(repo.full_name, github_pat)
+        return repo.html_url, commit_sha
 
     except Exception as e:
         # ... (error handling logic remains the same) ...
         print(f"❌ GitHub operation failed: {e}")
         return None, None
 
-def poll_for_deployment(pages_url: str, nonce_to_check: str, timeout: int = 240):
+async def poll_for_deployment(pages_url: str, nonce_to_check: str, repo_full_name: str, token: str, timeout: int = 240):
     """
-    Checks a URL at a fixed interval until it's live and contains a specific nonce.
+    Waits for the latest GitHub Pages build to finish, then confirms the live page contains a specific nonce.
+    The build status is polled with exponential backoff (2s, 4s, 8s, ...) capped at POLLING_TIME.
     """
-    print(f"📡 Polling {pages_url} for deployment...")
-    print(f"   (Looking for nonce: {nonce_to_check})")
+    print(f"📡 Polling Pages build for {repo_full_name}...")
+    print(f"   (Looking for nonce: {nonce_to_check} at {pages_url})")
     
-    # Load the fixed polling interval from .env, defaulting to 15 seconds
+    # Load the maximum polling interval from .env, defaulting to 15 seconds
     try:
-        polling_interval = int(os.getenv("POLLING_TIME", "15"))
+        max_interval = int(os.getenv("POLLING_TIME", "15"))
     except ValueError:
         print("⚠️  Warning: POLLING_TIME in .env is not a valid number. Defaulting to 15s.")
-        polling_interval = 15
+        max_interval = 15
 
-    print(f"   (Checking every {polling_interval} seconds)")
+    builds_url = f"https://api.github.com/repos/{repo_full_name}/pages/builds/latest"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+    nonce_meta_tag = deployment_nonce_tag(nonce_to_check)
 
     start_time = time.time()
+    interval = 2
+    last_etag = None
     while time.time() - start_time < timeout:
         elapsed_time = time.time() - start_time
+        delay = interval
         try:
-            response = requests.get(pages_url, timeout=10)
-            
-            if response.status_code == 200:
-                nonce_meta_tag = f'<meta name="deployment-nonce" content="{nonce_to_check}">'
-                if nonce_meta_tag in response.text:
-                    print(f"✅ Deployment confirmed live after {elapsed_time:.0f} seconds!")
-                    return True
-                else:
-                    print(f"   [{elapsed_time:.0f}s/{timeout}s] Site is live, but new content not yet visible. Waiting...")
+            response = await app.state.http.get(builds_url, headers=headers, timeout=10)
+            build_status = response.json().get("status") if response.status_code == 200 else None
+
+            if build_status == "built":
+                # The build is done; only now fetch the page itself to check for the new nonce.
+                # A 304 means the page is unchanged since our last look, so skip the download and the check.
+                page_headers = {"If-None-Match": last_etag} if last_etag else {}
+                page = await app.state.http.get(pages_url, headers=page_headers, timeout=10)
+                if page.status_code == 200:
+                    last_etag = page.headers.get("ETag")
+                    if nonce_meta_tag in page.text:
+                        print(f"✅ Deployment confirmed live after {elapsed_time:.0f} seconds!")
+                        return True
+                print(f"   [{elapsed_time:.0f}s/{timeout}s] Build finished, but new content not yet visible. Waiting...")
+            elif response.status_code == 200:
+                print(f"   [{elapsed_time:.0f}s/{timeout}s] Pages build status: {build_status}. Waiting...")
+            elif response.headers.get("x-ratelimit-remaining") == "0":
+                # Rate limited: don't poll again before the window resets (capped like retry_delay)
+                reset_at = int(response.headers.get("x-ratelimit-reset", "0"))
+                delay = min(max(delay, reset_at - time.time()), GITHUB_MAX_RETRY_DELAY)
+                print(f"   [{elapsed_time:.0f}s/{timeout}s] Rate limited by GitHub. Waiting {delay:.0f}s...")
             else:
-                 print(f"   [{elapsed_time:.0f}s/{timeout}s] Site not ready (Status: {response.status_code}). Waiting...")
-                 
-        except requests.exceptions.RequestException:
-            print(f"   [{elapsed_time:.0f}s/{timeout}s] Site not reachable yet. Retrying...")
+                print(f"   [{elapsed_time:.0f}s/{timeout}s] Build not ready (Status: {response.status_code}). Waiting...")
 
-        # Use the fixed interval loaded from the environment
-        time.sleep(polling_interval)
+        except (httpx.HTTPError, ValueError):
+            print(f"   [{elapsed_time:.0f}s/{timeout}s] Pages build status not reachable yet. Retrying...")
+
+        # Never sleep past the overall timeout
+        remaining = timeout - (time.time() - start_time)
+        await asyncio.sleep(max(0, min(delay, remaining)))
+        interval = min(interval * 2, max_interval)
 
     print(f"❌ Polling timed out after {timeout} seconds. Deployment failed.")
     return False
 
-def send_callback(payload: dict, evaluation_url: str):
+async def send_callback(payload: dict, evaluation_url: str):
     """
-    Sends the final payload to the evaluation URL with exponential backoff retry.
+    Sends the final payload to the evaluation URL with jittered exponential backoff retry.
     """
     print(f"📞 Sending callback to {evaluation_url}...")
     
     max_retries = 5
     for attempt in range(max_retries):
         try:
-            response = requests.post(evaluation_url, json=payload, timeout=15)
+            response = await app.state.http.post(evaluation_url, json=payload, timeout=15)
             if response.status_code == 200:
                 print("✅ Callback successfully sent and acknowledged.")
                 return True
             else:
                 print(f"⚠️ Callback server returned an error (Status: {response.status_code}). Retrying...")
         
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"⚠️ Callback failed with connection error: {e}. Retrying...")
         
         if attempt < max_retries - 1:
-            delay = 2 ** attempt # Exponential backoff: 1, 2, 4, 8 seconds
-            print(f"   Waiting {delay}s before next attempt.")
-            time.sleep(delay)
+            # Exponential backoff (1, 2, 4, 8... capped at 30s) with full jitter, so failing tasks don't retry in lockstep
+            delay = random.uniform(0, min(30, 2 ** attempt))
+            print(f"   Waiting {delay:.1f}s before next attempt.")
+            await asyncio.sleep(delay)
             
     print("❌ Failed to send callback after multiple retries.")
     return False
 
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Everything round 2 needs from an existing repo, fetched in a single request
+REPO_SNAPSHOT_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    url
+    indexHtml: object(expression: "main:index.html") { ... on Blob { text isTruncated } }
+  }
+}
+"""
+
+async def fetch_repo_snapshot(owner: str, repo_name: str, token: str):
+    """
+    Fetches the repo URL and the current index.html with one GraphQL query.
+    Returns the `repository` object, or None if the repo does not exist.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    payload = {"query": REPO_SNAPSHOT_QUERY, "variables": {"owner": owner, "name": repo_name}}
+    response = await github_request("POST", GITHUB_GRAPHQL_URL, headers=headers, json=payload)
+    response.raise_for_status()
+    result = response.json()
+
+    errors = result.get("errors") or []
+    if any(error.get("type") == "NOT_FOUND" for error in errors):
+        return None
+    if errors:
+        raise Exception(f"GraphQL query failed: {errors[0].get('message')}")
+    return result["data"]["repository"]
+
 # In main.py
 from github import Github, UnknownObjectException # Add UnknownObjectException for error handling
 
-def fetch_and_update_repo(request_data: TaskRequest) -> (str, str):
+async def fetch_and_update_repo(request_data: TaskRequest, attachments: list) -> (str, str):
     """
     Fetches an existing repo, updates its content based on a new brief, injects the new nonce, and returns the repo URL and commit SHA in a single commit.
     """
@@ -282,13 +745,25 @@ def fetch_and_update_repo(request_data: TaskRequest) -> (str, str):
     github_pat = os.getenv("GITHUB_PAT")
 
     try:
-        g = Github(github_pat)
-        user = g.get_user()
-        repo = user.get_repo(repo_name)
-        
+        owner = os.getenv("GITHUB_USERNAME")
+        snapshot = await fetch_repo_snapshot(owner, repo_name, github_pat)
+        if snapshot is None:
+            print(f"❌ Error: The repository '{repo_name}' was not found for the update.")
+            return None, None
+
+        # Lazy: the snapshot already has what we need, so don't spend a request loading the repo
+        repo = get_github_client().get_repo(f"{owner}/{repo_name}", lazy=True)
+
         # Fetch existing code for the revision prompt
-        index_file = repo.get_contents("index.html")
-        old_html_code = index_file.decoded_content.decode("utf-8")
+        index_blob = snapshot["indexHtml"]
+        if not index_blob:
+            raise Exception("index.html is missing from the repository.")
+        if index_blob["isTruncated"] or index_blob["text"] is None:
+            # GraphQL truncates large blobs; fall back to the REST contents API
+            index_file = await asyncio.to_thread(repo.get_contents, "index.html")
+            old_html_code = index_file.decoded_content.decode("utf-8")
+        else:
+            old_html_code = index_blob["text"]
 
         revision_brief = f"""
         Your task is to modify the following existing HTML code based on a new requirement.
@@ -303,30 +778,31 @@ def fetch_and_update_repo(request_data: TaskRequest) -> (str, str):
         """
         
         # --- FIX: Pass attachments to the LLM ---
-        new_html_code = generate_code_with_llm(revision_brief, request_data.checks, request_data.attachments)
+        new_html_code = await generate_code_with_llm(revision_brief, request_data.checks, attachments)
         if not new_html_code or new_html_code.startswith("<h1>Error"):
             raise Exception("LLM failed to generate a valid revision.")
 
         # --- OPTIMIZATION: Inject the new nonce BEFORE committing ---
-        nonce_meta_tag = f'<meta name="deployment-nonce" content="{request_data.nonce}">'
-        final_html_code = new_html_code.replace("</head>", f"    {nonce_meta_tag}\n</head>", 1)
+        final_html_code = inject_nonce(new_html_code, request_data.nonce)
 
         # --- FIX: Update the README.md file ---
-        readme_file = repo.get_contents("README.md")
         new_readme_content = f"# {repo_name}\n\n**Latest Brief (Round {request_data.round}):**\n{request_data.brief}"
-        repo.update_file(
-            path="README.md", message=f"docs: update for round {request_data.round}",
-            content=new_readme_content, sha=readme_file.sha, branch="main"
-        )
+        files = [
+            ("index.html", final_html_code, "utf-8"),
+            ("README.md", new_readme_content, "utf-8"),
+        ]
+
+        # The page references attachments by filename, so they must be in the repo too
+        if attachments:
+            print("📎 Processing attachments...")
+            files += attachment_files(attachments)
 
-        # Update the main index.html with the final code
-        update_commit = repo.update_file(
-            path="index.html", message=f"feat: apply round {request_data.round} revisions",
-            content=final_html_code, sha=index_file.sha, branch="main"
-        )["commit"]
+        commit_sha = await commit_files_to_repo(
+            f"{owner}/{repo_name}", files, f"feat: apply round {request_data.round} revisions"
+        )
         
         print("✅ Successfully updated repository in a single commit.")
-        return repo.html_url, update_commit.sha
+        return snapshot["url"], commit_sha
 
     except UnknownObjectException:
         print(f"❌ Error: The repository '{repo_name}' was not found for the update.")
@@ -337,30 +813,46 @@ def fetch_and_update_repo(request_data: TaskRequest) -> (str, str):
 
 # In main.py, replace your existing process_and_deploy_task function with this one
 
-def process_and_deploy_task(request_data: TaskRequest):
+async def process_and_deploy_task(request_data: TaskRequest):
     print(f"🚀 Starting background processing for task: {request_data.task}, Round: {request_data.round}")
-    
+
+    # Parse the attachment data URIs once; the LLM prompt and the repo upload both reuse the result
+    # Off the event loop: spooling large payloads would otherwise stall every in-flight task
+    attachments = await asyncio.to_thread(preprocess_attachments, request_data.attachments)
+    try:
+        await run_deploy_pipeline(request_data, attachments)
+    finally:
+        for attachment in attachments:
+            attachment["data"].close()
+
+async def run_deploy_pipeline(request_data: TaskRequest, attachments: list):
     repo_name = request_data.task
     repo_url, commit_sha = None, None
 
     # --- Dispatch based on the round number ---
     if request_data.round == 1:
-        html_code = generate_code_with_llm(request_data.brief, request_data.checks, request_data.attachments)
+        # The repo setup doesn't depend on the generated code, so run it alongside the LLM call
+        llm_task = asyncio.create_task(
+            generate_code_with_llm(request_data.brief, request_data.checks, attachments)
+        )
+        repo_task = asyncio.create_task(create_github_repo(repo_name, request_data.brief))
+        repo, html_code = await asyncio.gather(repo_task, llm_task)
+
         if not html_code or html_code.startswith("<h1>Error"):
             print("❌ Halting task due to LLM code generation failure.")
             return
+        if repo is None:
+            print("❌ Halting task due to GitHub repository creation failure.")
+            return
             
-        nonce_meta_tag = f'<meta name="deployment-nonce" content="{request_data.nonce}">'
-        html_code = html_code.replace("</head>", f"    {nonce_meta_tag}\n</head>", 1)
+        html_code = inject_nonce(html_code, request_data.nonce)
         
         # Call the updated function with attachments
-        repo_url, commit_sha = create_and_push_to_github(
-            repo_name, html_code, request_data.brief, request_data.attachments
-        )
+        repo_url, commit_sha = await create_and_push_to_github(repo, html_code, attachments)
     
     else: # Handle Round 2 and any subsequent rounds
         # Call the new, optimized update function
-        repo_url, commit_sha = fetch_and_update_repo(request_data)
+        repo_url, commit_sha = await fetch_and_update_repo(request_data, attachments)
 
     # --- Common logic for ALL rounds (remains unchanged) ---
     if not repo_url or not commit_sha:
@@ -370,7 +862,9 @@ def process_and_deploy_task(request_data: TaskRequest):
     github_username = os.getenv("GITHUB_USERNAME")
     pages_url = f"https://{github_username}.github.io/{repo_name}/"
     
-    is_live = poll_for_deployment(pages_url, request_data.nonce)
+    is_live = await poll_for_deployment(
+        pages_url, request_data.nonce, f"{github_username}/{repo_name}", os.getenv("GITHUB_PAT")
+    )
     if not is_live:
         print("❌ Halting task because deployment could not be verified.")
         return
@@ -380,7 +874,7 @@ def process_and_deploy_task(request_data: TaskRequest):
         "nonce": request_data.nonce, "repo_url": repo_url, "commit_sha": commit_sha,
         "pages_url": pages_url,
     }
-    send_callback(callback_payload, str(request_data.evaluation_url))
+    await send_callback(callback_payload, str(request_data.evaluation_url))
     
     print(f"✅ Finished processing for task: {request_data.task}, Round: {request_data.round}")
 